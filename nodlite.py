@@ -1,27 +1,79 @@
+import atexit
 import itertools
+import json
 import sqlite3
+import struct
+import weakref
 import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
 from enum import Enum
 from pickle import HIGHEST_PROTOCOL as PICKLE_PROTOCOL
 from pickle import dumps, loads
-from queue import Queue
-from threading import Thread
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
 
 __version__ = "0.0.3"
 
+# SQLite features newer than some of the builds Python ships with
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+SQLITE_WINDOW = sqlite3.sqlite_version_info >= (3, 25, 0)
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# open graphs, closed (and their pending writes committed) at exit
+_graphs = weakref.WeakSet()
+
+
+@atexit.register
+def _close_graphs():
+    for graph in list(_graphs):
+        graph.close()
+
 
 class Action(Enum):
     COMMIT = 0
     CLOSE = 1
     END = 2
+    EXECUTEMANY = 3
+    SELECT_ALL = 4
+    SCRIPT = 5
+    BATCH = 6
+    RETURNING = 7
+    SELECT_IN = 8
+    SYNC = 9
+
+
+class Stream(Queue):
+    """Queue the worker fills with the records of a streamed query.
+
+    The consumer sets `cancelled` when it stops reading early, which tells
+    the worker to drop the rest of the query.
+    """
+
+    def __init__(self, maxsize=0):
+        super(Stream, self).__init__(maxsize)
+        self.cancelled = Event()
 
 
 class Node:
-    __slots__ = ["key", "attributes"]
+    __slots__ = ["key", "attributes", "__dict__"]
 
     def __init__(self, key, attributes):
         self.key = key
         self.attributes = attributes
+        # attributes double as the instance dict: plain attribute access,
+        # and `attributes` still holds everything to serialize
+        self.__dict__ = attributes
 
     def __repr__(self):
         txt = f"Node(key='{self.key}'"
@@ -35,57 +87,213 @@ class Node:
         txt += ")"
         return txt
 
-    def __getattr__(self, name):
-        return self.attributes[name]
+    def __reduce__(self):
+        return Node, (self.key, self.attributes)
+
+
+# buffers larger than this are stored out-of-band, after the pickle frame
+OOB_THRESHOLD = 1 << 16
+# pickle frames always start with the PROTO opcode (0x80), never with this
+OOB_TAG = b"OOB5"
+
+
+def pickle_dumps(obj):
+    """Pickle an object, keeping large buffers out of the pickle frame.
+
+    Objects exposing buffers through protocol 5 (bytearray, NumPy arrays,
+    ...) larger than OOB_THRESHOLD are appended raw after the frame,
+    behind a header holding the buffer count and all the lengths.
+    """
+    buffers = []
+
+    def in_band(buffer):
+        if buffer.raw().nbytes < OOB_THRESHOLD:
+            return True
+        buffers.append(buffer.raw())
+        return False
+
+    frame = dumps(obj, protocol=PICKLE_PROTOCOL, buffer_callback=in_band)
+    if not buffers:
+        return frame
+
+    lengths = [len(frame)] + [buffer.nbytes for buffer in buffers]
+    header = struct.pack(f"<{len(lengths) + 1}Q", len(buffers), *lengths)
+    return b"".join([OOB_TAG, header, frame, *buffers])
+
+
+def pickle_loads(data):
+    """Unpickle data produced by `pickle_dumps`.
+
+    Out-of-band buffers are copied into bytearrays before being handed to
+    pickle, so that the objects rebuilt from them are writable.
+    """
+    if data[:len(OOB_TAG)] != OOB_TAG:
+        return loads(data)
+
+    offset = len(OOB_TAG)
+    n_buffers, = struct.unpack_from("<Q", data, offset)
+    lengths = struct.unpack_from(f"<{n_buffers + 1}Q", data, offset + 8)
+    offset += 8 * (n_buffers + 2)
+
+    view = memoryview(data)
+    frame = view[offset:offset + lengths[0]]
+    offset += lengths[0]
+    buffers = []
+    for length in lengths[1:]:
+        buffers.append(bytearray(view[offset:offset + length]))
+        offset += length
+    return loads(frame, buffers=buffers)
 
 
 def encode(obj):
     """Serialize an object using pickle to a binary format accepted by SQLite."""
-    return sqlite3.Binary(dumps(obj, protocol=PICKLE_PROTOCOL))
+    return sqlite3.Binary(pickle_dumps(obj))
 
 
 def decode(obj):
     """Deserialize objects retrieved from SQLite."""
-    return loads(bytes(obj))
+    return pickle_loads(bytes(obj))
 
 
 def zip_encode(obj):
-    return sqlite3.Binary(zlib.compress(dumps(obj, protocol=PICKLE_PROTOCOL)))
+    return sqlite3.Binary(zlib.compress(pickle_dumps(obj)))
 
 
 def zip_decode(obj):
-    return loads(zlib.decompress(bytes(obj)))
+    return pickle_loads(zlib.decompress(bytes(obj)))
+
+
+MSGPACK_TAG = b"m"
+PICKLE_TAG = b"p"
+
+
+def msgpack_dumps(obj):
+    """Serialize with msgpack, falling back to pickle for unsupported types.
+
+    A one-byte tag tells `msgpack_loads` which format was used. Types are
+    checked strictly, so that tuples and subclasses (which msgpack would
+    turn into their base type) go through pickle as well.
+    """
+    try:
+        return MSGPACK_TAG + msgpack.packb(
+            obj, use_bin_type=True, strict_types=True)
+    except (TypeError, OverflowError):
+        return PICKLE_TAG + pickle_dumps(obj)
+
+
+def msgpack_loads(data):
+    if data[:1] == MSGPACK_TAG:
+        return msgpack.unpackb(data[1:], raw=False, strict_map_key=False)
+    return pickle_loads(data[1:])
+
+
+def lz4_compress(data):
+    return lz4.block.compress(data)
+
+
+def lz4_decompress(data):
+    return lz4.block.decompress(data)
+
+
+SERIALIZERS = {
+    "pickle": (pickle_dumps, pickle_loads),
+    "msgpack": (msgpack_dumps, msgpack_loads),
+}
+
+COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lz4": (lz4_compress, lz4_decompress),
+}
+
+
+def make_codec(codec="pickle", compress=None):
+    """Build the (encode, decode) pair used to store node attributes."""
+    if codec not in SERIALIZERS:
+        raise ValueError(f"Unknown codec '{codec}'")
+    if compress is not None and compress not in COMPRESSORS:
+        raise ValueError(f"Unknown compression '{compress}'")
+    if codec == "msgpack" and msgpack is None:
+        raise ImportError("codec='msgpack' requires the msgpack package")
+    if compress == "lz4" and lz4 is None:
+        raise ImportError("compress='lz4' requires the lz4 package")
+
+    pack, unpack = SERIALIZERS[codec]
+    if compress is None:
+        def encode_attributes(obj):
+            return sqlite3.Binary(pack(obj))
+
+        def decode_attributes(obj):
+            return unpack(bytes(obj))
+    else:
+        compress_data, decompress_data = COMPRESSORS[compress]
+
+        def encode_attributes(obj):
+            return sqlite3.Binary(compress_data(pack(obj)))
+
+        def decode_attributes(obj):
+            return unpack(decompress_data(bytes(obj)))
+    return encode_attributes, decode_attributes
 
 
 class Graph:
+    CREATE_EDGE_INDEX = '''
+        CREATE INDEX IF NOT EXISTS source_idx ON edges (source);
+        CREATE INDEX IF NOT EXISTS target_idx ON edges (target);
+    '''
+
     def __init__(
         self,
         filename,
-        journal_mode="OFF",
-        zip=False
+        journal_mode="WAL",
+        zip=False,
+        codec="pickle",
+        compress=None,
+        batch_size=1000,
+        synchronous="NORMAL",
+        temp_store="MEMORY",
+        mmap_size=268435456,
+        cache_size=-65536,
+        page_size=8192,
+        locking_mode="NORMAL"
     ):
         self.filename = filename
-        self.journal_mode = journal_mode
-        if zip:
-            self.encode = zip_encode
-            self.decode = zip_decode
-        else:
-            self.encode = encode
-            self.decode = decode
+        # page_size comes first: it must be set before the journal mode
+        # switches to WAL and before any table is created
+        self.pragmas = {
+            "page_size": page_size,
+            "journal_mode": journal_mode,
+            "synchronous": synchronous,
+            "temp_store": temp_store,
+            "mmap_size": mmap_size,
+            "cache_size": cache_size,
+            "locking_mode": locking_mode,
+        }
+        # writes are committed every `batch_size` operations or on flush()
+        self._pending = 0
+        self._batch = batch_size
+        # add_edges_from hands edges over to the worker this many at a time
+        self._chunk_size = 10000
+        if zip and compress is None:
+            compress = "zlib"
+        self.encode, self.decode = make_codec(codec, compress)
 
         self.conn = self._new_conn()
+        _graphs.add(self)
         self._create_tables()
 
     def _new_conn(self):
-        return GraphMultithread(self.filename, journal_mode=self.journal_mode)
+        return GraphMultithread(self.filename, pragmas=self.pragmas)
 
     def __enter__(self):
         if not hasattr(self, "conn") or self.conn is None:
             self.conn = self._new_conn()
         return self
 
-    def __exit__(self):
-        self.close()
+    def __exit__(self, *exc):
+        try:
+            self.flush()
+        finally:
+            self.close()
 
     def _create_tables(self):
         MAKE_TABLES = '''
@@ -98,38 +306,80 @@ class Graph:
                 UNIQUE(source, target) ON CONFLICT IGNORE,
                 FOREIGN KEY(source) REFERENCES nodes(key),
                 FOREIGN KEY(target) REFERENCES nodes(key)
-            )
+            );
         '''
-        self.conn.executescript(MAKE_TABLES)
-
-        CREATE_EDGE_INDEX = '''
-            CREATE INDEX IF NOT EXISTS source_idx ON edges (source);
-            CREATE INDEX IF NOT EXISTS target_idx ON edges (target);
+        # node and edge counts are maintained by triggers, seeded from the
+        # tables the first time (the seeding is a no-op afterwards)
+        CREATE_COUNTERS = '''
+            DROP VIEW IF EXISTS count_nodes;
+            DROP VIEW IF EXISTS count_edges;
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT NOT NULL PRIMARY KEY,
+                n INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (name, n)
+                SELECT 'nodes', COUNT(*) FROM nodes WHERE NOT EXISTS (
+                    SELECT 1 FROM meta WHERE name = 'nodes');
+            INSERT OR IGNORE INTO meta (name, n)
+                SELECT 'edges', COUNT(*) FROM edges WHERE NOT EXISTS (
+                    SELECT 1 FROM meta WHERE name = 'edges');
+            CREATE TRIGGER IF NOT EXISTS nodes_insert AFTER INSERT ON nodes
+                BEGIN UPDATE meta SET n = n + 1 WHERE name = 'nodes'; END;
+            CREATE TRIGGER IF NOT EXISTS nodes_delete AFTER DELETE ON nodes
+                BEGIN UPDATE meta SET n = n - 1 WHERE name = 'nodes'; END;
+            CREATE TRIGGER IF NOT EXISTS edges_insert AFTER INSERT ON edges
+                BEGIN UPDATE meta SET n = n + 1 WHERE name = 'edges'; END;
+            CREATE TRIGGER IF NOT EXISTS edges_delete AFTER DELETE ON edges
+                BEGIN UPDATE meta SET n = n - 1 WHERE name = 'edges'; END;
         '''
-        self.conn.executescript(CREATE_EDGE_INDEX)
+        self.conn.executescript(
+            MAKE_TABLES + self.CREATE_EDGE_INDEX + CREATE_COUNTERS)
+
+        self.conn.commit()
+
+    def _create_indexes(self):
+        self.conn.executescript(self.CREATE_EDGE_INDEX)
 
-        CREATE_COUNT_VIEW = '''
-            CREATE VIEW IF NOT EXISTS count_nodes(n_nodes)
-                AS SELECT COUNT(*) FROM nodes;
-            CREATE VIEW IF NOT EXISTS count_edges(n_edges)
-                AS SELECT COUNT(*) FROM edges;
+    def _drop_indexes(self):
+        DROP_EDGE_INDEX = '''
+            DROP INDEX IF EXISTS source_idx;
+            DROP INDEX IF EXISTS target_idx;
         '''
-        self.conn.executescript(CREATE_COUNT_VIEW)
+        self.conn.executescript(DROP_EDGE_INDEX)
 
-        self.conn.commit()
+    @contextmanager
+    def bulk_load(self):
+        """Drop the edge indexes while inserting, then rebuild them once.
+
+        Edge lookups are not indexed inside the block, so it is best
+        suited to write-only ingestion.
+        """
+        self._drop_indexes()
+        self.commit()
+        try:
+            yield self
+        finally:
+            self._create_indexes()
+            self.conn.execute("ANALYZE")
+            self.commit()
 
     def close(self):
-        self.conn.close()
+        conn = getattr(self, "conn", None)
+        if conn is None:
+            return
+        self.conn = None
+        self._pending = 0
+        # commits pending writes and waits for the worker to finish
+        conn.close()
 
     @property
     def n_nodes(self):
-        GET_N_NODES = 'SELECT n_nodes FROM "count_nodes"'
-        return next(self.conn.select(GET_N_NODES))[0]
+        GET_N_NODES = 'SELECT n FROM "meta" WHERE name = ?'
+        return next(self.conn.select(GET_N_NODES, ("nodes",)))[0]
 
     @property
     def n_edges(self):
-        GET_N_EDGES = 'SELECT n_edges FROM "count_edges"'
-        return next(self.conn.select(GET_N_EDGES))[0]
+        GET_N_EDGES = 'SELECT n FROM "meta" WHERE name = ?'
+        return next(self.conn.select(GET_N_EDGES, ("edges",)))[0]
 
     def node(self, key):
         GET_NODE = 'SELECT key, attributes FROM "nodes" WHERE key = ?'
@@ -151,21 +401,63 @@ class Graph:
             return False
 
     def add_node(self, key, **attributes):
+        """Add a node, replacing the attributes of an existing one if given."""
         if len(attributes) == 0:
             ADD_NODE = '''
                 INSERT OR IGNORE INTO "nodes" (key) VALUES (?)
             '''
             self.conn.execute(ADD_NODE, (key,))
+        elif SQLITE_UPSERT:
+            # unlike REPLACE, keeps the rowid (and position) of the node
+            ADD_NODE = '''
+                INSERT INTO "nodes" (key, attributes) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET attributes = excluded.attributes
+            '''
+            self.conn.execute(ADD_NODE, (key, self.encode(attributes)))
         else:
             ADD_NODE = 'REPLACE INTO "nodes" (key, attributes) VALUES (?,?)'
             self.conn.execute(ADD_NODE, (key, self.encode(attributes)))
 
-        self.commit()
+        self._autocommit()
+
+    def add_node_returning(self, key, **attributes):
+        """Add a node like `add_node`, and return its rowid.
+
+        Return None if the node was given no attributes and already existed.
+        Unlike add_node, this waits for the worker thread to run the write.
+        """
+        if not SQLITE_RETURNING:
+            GET_ROWID = 'SELECT rowid FROM "nodes" WHERE key = ?'
+            existed = self.conn.select_one(GET_ROWID, (key,)) is not None
+            self.add_node(key, **attributes)
+            if existed and not attributes:
+                return None
+            return self.conn.select_one(GET_ROWID, (key,))[0]
+
+        if len(attributes) == 0:
+            ADD_NODE = '''
+                INSERT OR IGNORE INTO "nodes" (key) VALUES (?)
+                RETURNING rowid
+            '''
+            rows = self.conn.execute_returning(ADD_NODE, (key,))
+        else:
+            ADD_NODE = '''
+                INSERT INTO "nodes" (key, attributes) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET attributes = excluded.attributes
+                RETURNING rowid
+            '''
+            rows = self.conn.execute_returning(
+                ADD_NODE, (key, self.encode(attributes)))
+
+        self._autocommit()
+        if rows:
+            return rows[0][0]
+        return None
 
     def add_nodes_from(self, keys):
-        for key in keys:
-            ADD_ITEM = 'REPLACE INTO "nodes" (key) VALUES (?)'
-            self.conn.execute(ADD_ITEM, (key,))
+        ADD_ITEM = 'REPLACE INTO "nodes" (key) VALUES (?)'
+        # parameters are built here: the worker must not iterate caller data
+        self.conn.executemany(ADD_ITEM, list(zip(keys)))
         self.commit()
 
     def remove_node(self, u):
@@ -175,6 +467,7 @@ class Graph:
 
         DEL_NODE = 'DELETE FROM "nodes" WHERE key = ?'
         self.conn.execute(DEL_NODE, (u,))
+        self._autocommit()
 
     def edge(self, u, v):
         GET_EDGE = 'SELECT COUNT() FROM "edges" WHERE source=? AND target=?'
@@ -198,29 +491,37 @@ class Graph:
             INSERT OR IGNORE INTO "edges" (source, target) VALUES (?, ?)
         '''
         self.conn.execute(ADD_EDGE, (source, target))
-        self.commit()
+        self._autocommit()
 
     def add_edges_from(self, edges):
-        n_edges = len(edges)
-        if n_edges == 0:
-            return
-        edges = list(itertools.chain(*edges))
-        nodes = list(set(edges))
-
-        QUERY = ", ".join(["(?)" for _ in range(len(nodes))])
-        ADD_NODES = 'INSERT OR IGNORE INTO "nodes" (key) VALUES ' + QUERY
-        self.conn.execute(ADD_NODES, nodes)
-
-        QUERY = ", ".join(["(?, ?)" for _ in range(n_edges)])
-        ADD_EDGES = 'INSERT OR IGNORE INTO "edges" (source, target) VALUES'
-        ADD_EDGES += QUERY
-        self.conn.execute(ADD_EDGES, edges)
-        self.conn.commit()
+        ADD_NODES = 'INSERT OR IGNORE INTO "nodes" (key) VALUES (?)'
+        ADD_EDGES = '''
+            INSERT OR IGNORE INTO "edges" (source, target) VALUES (?, ?)
+        '''
+        # edges are streamed in fixed-size chunks, materialized here: the
+        # worker must never iterate caller data (which may read the graph)
+        edges = iter(edges)
+        synced = None
+        while True:
+            chunk = list(itertools.islice(edges, self._chunk_size))
+            if not chunk:
+                break
+            nodes = set(itertools.chain.from_iterable(chunk))
+            # zip builds the 1-tuples of parameters in C
+            self.conn.executemany(ADD_NODES, list(zip(nodes)))
+            self.conn.executemany(ADD_EDGES, chunk)
+            # the next chunk is built while the worker inserts this one, but
+            # no further: at most two chunks are held in memory at once
+            if synced is not None:
+                synced.result()
+            synced = self.conn.sync()
+        self.commit()
 
     def remove_edge(self, u, v):
         # delete all edges starting from u
         DEL_EDGES = 'DELETE FROM "edges" WHERE source = ? and target = ?'
         self.conn.execute(DEL_EDGES, (u, v))
+        self._autocommit()
 
     def neighbors(self, source):
         GET_NEIGHBORS = '''
@@ -230,25 +531,51 @@ class Graph:
             yield it[0]
     
     def random_neighbors(self, source, n=1):
-        GET_RANDOM_NEIGHBORS = f'''
+        GET_RANDOM_NEIGHBORS = '''
             SELECT target FROM "edges" WHERE source = ?
-            ORDER BY RANDOM() LIMIT {n};
+            ORDER BY RANDOM() LIMIT ?;
         '''
         if n == 1:
-            return next(self.conn.select(GET_RANDOM_NEIGHBORS, (source,)))[0]
+            return next(self.conn.select(GET_RANDOM_NEIGHBORS, (source, n)))[0]
         else:
             res = []
-            for it in self.conn.select(GET_RANDOM_NEIGHBORS, (source,)):
+            for it in self.conn.select(GET_RANDOM_NEIGHBORS, (source, n)):
                 res.append(it[0])
             return res
 
     def neighbors_from(self, nodes):
-        QUERY = ', '.join(["?" for _ in range(len(nodes))])
-        GET_NEIGHBORS = f'''
-            SELECT source, target FROM "edges" WHERE source IN ({QUERY})
+        GET_NEIGHBORS = '''
+            SELECT source, json_group_array(target) FROM "edges"
+            WHERE source IN (SELECT key FROM "_nodes_in") GROUP BY source
+        '''
+        # JSON arrays round-trip any key, whatever characters it holds
+        return {src: json.loads(tgts)
+                for src, tgts in self.conn.select_in(nodes, GET_NEIGHBORS)}
+
+    def random_neighbors_from(self, nodes, n=1):
+        if not SQLITE_WINDOW:
+            # without window functions, sample each node on its own
+            GET_RANDOM_NEIGHBORS = '''
+                SELECT source, target FROM "edges" WHERE source = ?
+                ORDER BY RANDOM() LIMIT ?
+            '''
+            data = {}
+            for node in set(nodes):
+                for src, tgt in self.conn.select(
+                        GET_RANDOM_NEIGHBORS, (node, n)):
+                    data.setdefault(src, []).append(tgt)
+            return data
+
+        GET_RANDOM_NEIGHBORS = '''
+            SELECT source, target FROM (
+                SELECT source, target, ROW_NUMBER() OVER (
+                    PARTITION BY source ORDER BY RANDOM()) AS rank
+                FROM "edges" WHERE source IN (SELECT key FROM "_nodes_in")
+            ) WHERE rank <= ?
         '''
         data = {}
-        for src, tgt in self.conn.select(GET_NEIGHBORS, nodes):
+        records = self.conn.select_in(nodes, GET_RANDOM_NEIGHBORS, (n,))
+        for src, tgt in records:
             data.setdefault(src, []).append(tgt)
         return data
 
@@ -269,25 +596,51 @@ class Graph:
             yield it[0]
 
     def random_predecessors(self, target, n=1):
-        GET_RANDOM_PREDECESSORS = f'''
+        GET_RANDOM_PREDECESSORS = '''
             SELECT source FROM "edges" WHERE target = ?
-            ORDER BY RANDOM() LIMIT {n};
+            ORDER BY RANDOM() LIMIT ?;
         '''
         if n == 1:
-            return next(self.conn.select(GET_RANDOM_PREDECESSORS, (target,)))[0]
+            return next(self.conn.select(GET_RANDOM_PREDECESSORS, (target, n)))[0]
         else:
             res = []
-            for it in self.conn.select(GET_RANDOM_PREDECESSORS, (target,)):
+            for it in self.conn.select(GET_RANDOM_PREDECESSORS, (target, n)):
                 res.append(it[0])
             return res
 
     def predecessors_from(self, nodes):
-        QUERY = ', '.join(["?" for _ in range(len(nodes))])
-        GET_PREDECESSORS = f'''
-            SELECT source, target FROM "edges" WHERE target IN ({QUERY})
+        GET_PREDECESSORS = '''
+            SELECT target, json_group_array(source) FROM "edges"
+            WHERE target IN (SELECT key FROM "_nodes_in") GROUP BY target
+        '''
+        return {tgt: json.loads(srcs)
+                for tgt, srcs in self.conn.select_in(
+                    nodes, GET_PREDECESSORS)}
+
+    def random_predecessors_from(self, nodes, n=1):
+        if not SQLITE_WINDOW:
+            # without window functions, sample each node on its own
+            GET_RANDOM_PREDECESSORS = '''
+                SELECT source, target FROM "edges" WHERE target = ?
+                ORDER BY RANDOM() LIMIT ?
+            '''
+            data = {}
+            for node in set(nodes):
+                for src, tgt in self.conn.select(
+                        GET_RANDOM_PREDECESSORS, (node, n)):
+                    data.setdefault(tgt, []).append(src)
+            return data
+
+        GET_RANDOM_PREDECESSORS = '''
+            SELECT source, target FROM (
+                SELECT source, target, ROW_NUMBER() OVER (
+                    PARTITION BY target ORDER BY RANDOM()) AS rank
+                FROM "edges" WHERE target IN (SELECT key FROM "_nodes_in")
+            ) WHERE rank <= ?
         '''
         data = {}
-        for src, tgt in self.conn.select(GET_PREDECESSORS, nodes):
+        records = self.conn.select_in(nodes, GET_RANDOM_PREDECESSORS, (n,))
+        for src, tgt in records:
             data.setdefault(tgt, []).append(src)
         return data
 
@@ -301,13 +654,12 @@ class Graph:
         self.add_edges_from(edges)
 
     def subgraph(self, nodes):
-        QUERY = ', '.join(["?" for _ in range(len(nodes))])
-        GET_SUBGRAPH = f'''
+        GET_SUBGRAPH = '''
             SELECT source, target FROM "edges"
-            WHERE source IN ({QUERY}) AND target IN ({QUERY})
+            WHERE source IN (SELECT key FROM "_nodes_in")
+            AND target IN (SELECT key FROM "_nodes_in")
         '''
-        for it in self.conn.select(GET_SUBGRAPH, nodes * 2):
-            yield it
+        yield from self.conn.select_in(nodes, GET_SUBGRAPH)
 
     def degree(self, source):
         GET_DEGREE = '''
@@ -318,33 +670,41 @@ class Graph:
     @ property
     def nodes(self):
         GET_NODES = 'SELECT key, attributes FROM "nodes" ORDER BY rowid'
-        for it in self.conn.select(GET_NODES):
-            if it[1] is None:
-                yield it[0]
-            yield Node(it[0], self.decode(it[1]))
+        decode = self.decode
+        for key, attributes in self.conn.stream(GET_NODES):
+            if attributes is None:
+                yield key
+            else:
+                yield Node(key, decode(attributes))
 
     @ property
     def edges(self):
         GET_EDGES = 'SELECT source, target FROM "edges" ORDER BY rowid'
-        for it in self.conn.select(GET_EDGES):
+        for it in self.conn.stream(GET_EDGES):
             yield it
 
-    def batch_get_nodes(self, batch_size=100, page=0):
-        offset = page * batch_size
-        GET_NODES = f'''
-        SELECT key FROM "nodes" ORDER BY rowid
-        LIMIT {batch_size} OFFSET {offset}
+    def batch_get_nodes(self, batch_size=100, after_rowid=0):
+        """Yield (rowid, key) pairs for the batch following `after_rowid`.
+
+        Pass the last rowid of a batch to get the next one.
+        """
+        GET_NODES = '''
+        SELECT rowid, key FROM "nodes" WHERE rowid > ?
+        ORDER BY rowid LIMIT ?
         '''
-        for it in self.conn.select(GET_NODES):
-            yield it[0]
+        for it in self.conn.stream(GET_NODES, (after_rowid, batch_size)):
+            yield it
+
+    def batch_get_edges(self, batch_size=100, after_rowid=0):
+        """Yield (rowid, source, target) for the batch after `after_rowid`.
 
-    def batch_get_edges(self, batch_size=100, page=0):
-        offset = page * batch_size
-        GET_EDGES = f'''
-        SELECT source, target FROM "edges" ORDER BY rowid
-        LIMIT {batch_size} OFFSET {offset}
+        Pass the last rowid of a batch to get the next one.
+        """
+        GET_EDGES = '''
+        SELECT rowid, source, target FROM "edges" WHERE rowid > ?
+        ORDER BY rowid LIMIT ?
         '''
-        for it in self.conn.select(GET_EDGES):
+        for it in self.conn.stream(GET_EDGES, (after_rowid, batch_size)):
             yield it
 
     def __getitem__(self, key):
@@ -362,9 +722,28 @@ class Graph:
         self.add_node(key, **attributes)
 
     def commit(self):
+        self._pending = 0
         if self.conn is not None:
             self.conn.commit()
 
+    def execute_many_ops(self, ops):
+        """Run a list of (sql, params) write statements in one transaction.
+
+        The statements are handed to the worker thread in a single request
+        and committed together.
+        """
+        self.conn.execute_batch(ops)
+        self.commit()
+
+    def flush(self):
+        """Commit all pending writes to the database."""
+        self.commit()
+
+    def _autocommit(self):
+        self._pending += 1
+        if self._pending >= self._batch:
+            self.commit()
+
     def clear(self):
         CLEAR_ALL = '''
             DELETE FROM "nodes";
@@ -390,72 +769,262 @@ class Graph:
 
 
 class GraphMultithread(Thread):
-    def __init__(self, filename, journal_mode):
+    def __init__(self, filename, pragmas):
         super(GraphMultithread, self).__init__()
-        self.conn = sqlite3.connect(filename)
         self.filename = filename
         self.reqs = Queue()
-        self.journal_mode = journal_mode
-        self._ready = False
+        self.pragmas = pragmas
+        # number of records handed over at once by stream(), and number of
+        # such chunks the worker may read ahead of the consumer
+        self.arraysize = 1024
+        self.stream_chunks = 4
+        # writes are buffered here and handed over in batches of this size
+        self._ops = []
+        self.ops_size = 256
+        # guards _ops, so that graphs can be written from several threads
+        self._ops_lock = Lock()
+        self._ready = Event()
+        self._error = None
         self.setDaemon(True)
         self.start()
+        # wait for the connection to be configured before serving requests
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
 
     def run(self):
-        conn = sqlite3.connect(
-            self.filename, isolation_level=None, check_same_thread=False)
-        conn.text_factory = lambda x: x.decode("utf8")
-        cursor = conn.cursor()
-
-        conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
-        conn.commit()
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA synchronous=OFF')
-        conn.commit()
-        self._ready = True
+        try:
+            conn = sqlite3.connect(
+                self.filename, isolation_level=None, check_same_thread=False)
+            conn.text_factory = lambda x: x.decode("utf8")
+            cursor = conn.cursor()
+
+            for name, value in self.pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            # rows deleted by REPLACE must fire the counters' delete triggers
+            cursor.execute('PRAGMA recursive_triggers=ON')
+            # holds the node keys of set queries (neighbors_from, ...)
+            cursor.execute(
+                'CREATE TEMP TABLE "_nodes_in" (key TEXT NOT NULL PRIMARY KEY)')
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
 
         res = None
+        # a failed write the caller does not wait for (executemany, batch)
+        # is rolled back on its own, and its error is raised by the next
+        # request that returns something, whatever it is
+        error = None
         while True:
             req, arg, res = self.reqs.get()
-            if req == Action.COMMIT:
-                conn.commit()
-                if res:
-                    res.put(Action.END)
-            elif req == Action.CLOSE:
-                break
+            if req == Action.COMMIT or req == Action.CLOSE:
+                try:
+                    if conn.in_transaction:
+                        conn.commit()
+                    if error is None:
+                        res.set_result(None)
+                    else:
+                        res.set_exception(error)
+                except Exception as e:
+                    res.set_exception(e)
+                error = None
+                if req == Action.CLOSE:
+                    break
+            elif req == Action.SYNC:
+                # the error is left for the next request, which the caller
+                # is sure to wait for
+                res.set_result(None)
+            elif res is not None and error is not None:
+                self._reply_error(res, error)
+                error = None
+            elif req == Action.BATCH:
+                # a failed statement is undone on its own, leaving the
+                # writes around it in the transaction
+                for op in arg:
+                    try:
+                        if not conn.in_transaction:
+                            cursor.execute("BEGIN")
+                        cursor.execute(*op)
+                    except Exception as e:
+                        # the first error is the one reported; the traceback
+                        # would keep this frame, and its cursor, alive in
+                        # the caller
+                        if error is None:
+                            error = e.with_traceback(None)
+            elif req == Action.EXECUTEMANY:
+                # all or nothing, without undoing the writes before it
+                try:
+                    if not conn.in_transaction:
+                        cursor.execute("BEGIN")
+                    cursor.execute("SAVEPOINT write")
+                    try:
+                        cursor.executemany(*arg)
+                    except Exception:
+                        cursor.execute("ROLLBACK TO write")
+                        raise
+                    finally:
+                        cursor.execute("RELEASE write")
+                except Exception as e:
+                    if error is None:
+                        error = e.with_traceback(None)
+            elif req == Action.SCRIPT:
+                # executescript commits the open transaction first, which is
+                # why a pending write error is raised above before it runs
+                try:
+                    cursor.executescript(arg)
+                    res.set_result(None)
+                except Exception as e:
+                    res.set_exception(e)
+            elif req == Action.SELECT_IN:
+                nodes, query, params = arg
+                try:
+                    # the temporary table is filled and read in a savepoint
+                    # of its own, which opens no transaction that outlives
+                    # the query
+                    cursor.execute("SAVEPOINT nodes_in")
+                    try:
+                        cursor.execute('DELETE FROM "_nodes_in"')
+                        cursor.executemany(
+                            'INSERT OR IGNORE INTO "_nodes_in" (key) '
+                            'VALUES (?)', nodes)
+                        cursor.execute(query, params)
+                        records = cursor.fetchall()
+                    finally:
+                        cursor.execute("RELEASE nodes_in")
+                    res.set_result(records)
+                except Exception as e:
+                    res.set_exception(e)
+            elif req == Action.SELECT_ALL or req == Action.RETURNING:
+                try:
+                    # writes returning rows join the current transaction
+                    if req == Action.RETURNING and not conn.in_transaction:
+                        cursor.execute("BEGIN")
+                    cursor.execute(*arg)
+                    res.set_result(cursor.fetchall())
+                except Exception as e:
+                    res.set_exception(e)
             else:
-                cursor.execute(req, arg)
-                if res:
-                    records = cursor.fetchall()
-                    for rec in records:
-                        res.put(rec)
-                    res.put(Action.END)
-                # conn.commit()
+                try:
+                    cursor.execute(req, arg)
+                    while not res.cancelled.is_set():
+                        records = cursor.fetchmany(self.arraysize)
+                        if not records:
+                            res.put(Action.END)
+                            break
+                        res.put(records)
+                except Exception as e:
+                    res.put(e)
+        cursor.close()
         conn.close()
 
+    @staticmethod
+    def _reply_error(res, error):
+        if isinstance(res, Future):
+            res.set_exception(error)
+        else:
+            res.put(error)
+
+    def _put(self, req, arg, res):
+        # buffered writes must reach the worker before any other request
+        with self._ops_lock:
+            self._flush_ops()
+            self.reqs.put((req, arg, res))
+
+    def _flush_ops(self):
+        # must be called with _ops_lock held
+        if self._ops:
+            self.reqs.put((Action.BATCH, self._ops, None))
+            self._ops = []
+
     def execute(self, req, arg=None, res=None):
-        self.reqs.put((req, arg or tuple(), res))
+        if res is None and not isinstance(req, Action):
+            # writes are handed over to the worker ops_size at a time
+            with self._ops_lock:
+                self._ops.append((req, arg or tuple()))
+                if len(self._ops) >= self.ops_size:
+                    self._flush_ops()
+        else:
+            self._put(req, arg or tuple(), res)
+
+    def execute_returning(self, req, arg=None):
+        """Run a write statement with a RETURNING clause and get its rows."""
+        res = Future()
+        self._put(Action.RETURNING, (req, arg or tuple()), res)
+        return res.result()
+
+    def execute_batch(self, ops):
+        """Run a list of (sql, params) write statements in one request."""
+        self._put(Action.BATCH, [(req, arg or tuple()) for req, arg in ops],
+                  None)
+
+    def executemany(self, req, args):
+        self._put(Action.EXECUTEMANY, (req, args), None)
 
-    def executescript(self, req, arg=None, res=None):
-        for r in req.split(";"):
-            self.execute(r)
+    def executescript(self, req):
+        res = Future()
+        self._put(Action.SCRIPT, req, res)
+        res.result()
+
+    def sync(self):
+        """Return a future set once the requests made so far are done."""
+        res = Future()
+        self._put(Action.SYNC, None, res)
+        return res
 
     def commit(self):
-        self.select_one(Action.COMMIT)
+        res = Future()
+        self.execute(Action.COMMIT, res=res)
+        res.result()
 
     def select_one(self, req, arg=None):
-        try:
-            return next(iter(self.select(req, arg)))
-        except StopIteration:
-            return None
+        return next(self.select(req, arg), None)
 
     def close(self):
-        self.execute(Action.CLOSE)
+        res = Future()
+        self._put(Action.CLOSE, None, res)
+        try:
+            res.result()
+        finally:
+            self.join()
 
     def select(self, req, arg=None):
-        res = Queue()
-        self.execute(req, arg, res)
-        while True:
-            rec = res.get()
-            if rec == Action.END:
-                break
-            yield rec
+        """Run a query and hand its whole result back in one piece."""
+        res = Future()
+        self._put(Action.SELECT_ALL, (req, arg or tuple()), res)
+        return iter(res.result())
+
+    def select_in(self, nodes, req, arg=None):
+        """Run a query reading the given nodes from the "_nodes_in" table.
+
+        Going through a table keeps the query text (and its prepared
+        statement) the same whatever the number of nodes.
+        """
+        res = Future()
+        # zip builds the 1-tuples of parameters in C
+        self._put(Action.SELECT_IN, (list(zip(nodes)), req, arg or tuple()),
+                  res)
+        return iter(res.result())
+
+    def stream(self, req, arg=None):
+        """Run a query and yield its records one by one."""
+        res = Stream(self.stream_chunks)
+        self._put(req, arg or tuple(), res)
+        try:
+            while True:
+                records = res.get()
+                if records == Action.END:
+                    break
+                if isinstance(records, Exception):
+                    raise records
+                yield from records
+        finally:
+            # the worker checks the flag between chunks, and puts at most
+            # one more once the queue is drained: it can never block on it
+            res.cancelled.set()
+            try:
+                while True:
+                    res.get_nowait()
+            except Empty:
+                pass